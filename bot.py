@@ -2,11 +2,16 @@ import os
 import json
 import logging
 import asyncio
-from datetime import datetime
-import pytz
-from telegram import Update, Bot
-from telegram.ext import Application, MessageHandler, filters, ContextTypes, CommandHandler
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import threading
+import time
+import functools
+import heapq
+import re
+from datetime import datetime, time as dtime, timezone as dt_timezone
+from zoneinfo import ZoneInfo
+from telegram import Update
+from telegram.ext import Application, AIORateLimiter, MessageHandler, filters, ContextTypes, CommandHandler
+import httpx
 from openai import OpenAI
 import gspread
 from google.oauth2.service_account import Credentials
@@ -18,64 +23,144 @@ GOOGLE_CREDS_JSON = os.environ.get("GOOGLE_CREDS_JSON")
 SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID")
 MY_CHAT_ID = int(os.environ.get("MY_CHAT_ID", "0"))
 TIMEZONE = "Asia/Tashkent"
+TZ = ZoneInfo(TIMEZONE)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- GOOGLE SHEETS ---
+_gs_lock = threading.Lock()
+_spreadsheet = None
+_worksheets = {}
+
 def get_sheet(sheet_name):
-    creds_dict = json.loads(GOOGLE_CREDS_JSON)
-    scopes = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
-    ]
-    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-    client = gspread.authorize(creds)
-    return client.open_by_key(SPREADSHEET_ID).worksheet(sheet_name)
+    global _spreadsheet
+    with _gs_lock:
+        if _spreadsheet is None:
+            creds_dict = json.loads(GOOGLE_CREDS_JSON)
+            scopes = [
+                "https://spreadsheets.google.com/feeds",
+                "https://www.googleapis.com/auth/drive"
+            ]
+            creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
+            client = gspread.authorize(creds)
+            _spreadsheet = client.open_by_key(SPREADSHEET_ID)
+        if sheet_name not in _worksheets:
+            _worksheets[sheet_name] = _spreadsheet.worksheet(sheet_name)
+        return _worksheets[sheet_name]
+
+# Кэш прочитанных листов: (имя, вид) -> (момент чтения, данные).
+# Между записями данные почти статичны, так что повторные "итоги"/"долги"
+# не должны каждый раз скачивать весь лист заново.
+_records_cache = {}
+
+def _get_cached(key, fetch, max_age):
+    cached = _records_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+    data = fetch()
+    _records_cache[key] = (time.monotonic(), data)
+    return data
+
+def get_cached_values(sheet_name, max_age=60):
+    return _get_cached(
+        (sheet_name, "values"),
+        lambda: get_sheet(sheet_name).get_all_values(),
+        max_age
+    )
+
+def get_month_values(sheet_name, current_month, max_age=60):
+    # Записи добавляются хронологически, поэтому текущий месяц — это хвост
+    # листа. Скачиваем одну колонку с датами, находим начало хвоста и
+    # забираем узкий диапазон A:E вместо всей истории.
+    def fetch():
+        sheet = get_sheet(sheet_name)
+        dates = sheet.col_values(1)
+        first = len(dates)
+        while first > 1 and dates[first - 1][3:10] == current_month:
+            first -= 1
+        if first == len(dates):
+            return []
+        return sheet.get(f"A{first + 1}:E{len(dates)}")
+    return _get_cached((sheet_name, "month:" + current_month), fetch, max_age)
+
+def invalidate_cache(sheet_name):
+    for key in [k for k in _records_cache if k[0] == sheet_name]:
+        _records_cache.pop(key, None)
+
+# Суммы в листе встречаются с пробелами-разделителями и запятой:
+# один проход translate на C вместо пары .replace на строку.
+_AMOUNT_TBL = str.maketrans({" ": "", ",": "."})
+
+def _to_amount(value):
+    s = str(value).translate(_AMOUNT_TBL)
+    return float(s) if s else 0.0
 
 def add_transaction(rows: list):
     sheet = get_sheet("Транзакции")
-    tz = pytz.timezone(TIMEZONE)
-    now = datetime.now(tz).strftime("%d.%m.%Y %H:%M")
-    for row in rows:
-        sheet.append_row([
+    now = datetime.now(TZ).strftime("%d.%m.%Y %H:%M")
+    payload = [
+        [
             now,
             row.get("тип", "расход"),
             row.get("сумма", 0),
             row.get("категория", "другое"),
             row.get("описание", "")
-        ])
+        ]
+        for row in rows
+    ]
+    sheet.append_rows(payload, value_input_option="USER_ENTERED", insert_data_option="INSERT_ROWS")
+    invalidate_cache("Транзакции")
+
+    # Долги дублируем в маленький лист "Долги" (Дата, Имя, Сумма со
+    # знаком), чтобы команда "долги" не сканировала всю историю.
+    debt_rows = []
+    for row in rows:
+        if row.get("тип") != "долг":
+            continue
+        name = str(row.get("описание", "")).strip()
+        if not name:
+            continue
+        amount = row.get("сумма", 0)
+        cat = row.get("категория")
+        if cat == "долг_выдал":
+            debt_rows.append([now, name, amount])
+        elif cat == "долг_получил":
+            debt_rows.append([now, name, -amount])
+    if debt_rows:
+        get_sheet("Долги").append_rows(debt_rows, value_input_option="USER_ENTERED", insert_data_option="INSERT_ROWS")
+        invalidate_cache("Долги")
 
 def get_month_stats():
-    sheet = get_sheet("Транзакции")
-    records = sheet.get_all_records()
-    tz = pytz.timezone(TIMEZONE)
-    now = datetime.now(tz)
+    now = datetime.now(TZ)
     current_month = now.strftime("%m.%Y")
+    # Колонки фиксированы порядком add_transaction:
+    # A Дата, B Тип, C Сумма, D Категория, E Описание.
+    rows = get_month_values("Транзакции", current_month)
 
     total_expense = 0
     total_income = 0
     categories = {}
     debts_given = 0
     debts_received = 0
+    cats_get = categories.get
 
-    for r in records:
+    for row in rows:
         try:
-            date_str = str(r.get("Дата", ""))
-            if len(date_str) >= 7 and date_str[3:10] == current_month:
-                amount = float(str(r.get("Сумма", 0)).replace(" ", "").replace(",", ".") or 0)
-                t = str(r.get("Тип", "")).lower()
-                cat = str(r.get("Категория", "другое"))
-                if t == "расход":
-                    total_expense += amount
-                    categories[cat] = categories.get(cat, 0) + amount
-                elif t == "доход":
-                    total_income += amount
-                elif t == "долг":
-                    if cat == "долг_выдал":
-                        debts_given += amount
-                    elif cat == "долг_получил":
-                        debts_received += amount
+            amount = _to_amount(row[2])
+            t = row[1].lower()
+            cat = row[3] if len(row) > 3 else ""
+            if t == "расход":
+                total_expense += amount
+                cat = cat or "другое"
+                categories[cat] = cats_get(cat, 0) + amount
+            elif t == "доход":
+                total_income += amount
+            elif t == "долг":
+                if cat == "долг_выдал":
+                    debts_given += amount
+                elif cat == "долг_получил":
+                    debts_received += amount
         except:
             continue
 
@@ -89,19 +174,20 @@ def get_month_stats():
     }
 
 # --- OPENAI ---
-def parse_message(text: str) -> list:
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    system_prompt = """You are a financial message parser. The user writes in Russian or Uzbek.
-Extract financial data and return ONLY a JSON array. No explanation, no markdown, no code blocks.
-
-If ONE transaction:
-[{"тип":"расход","сумма":15000,"категория":"транспорт","описание":"такси"}]
-
-If MULTIPLE transactions:
-[{"тип":"расход","сумма":8000,"категория":"еда","описание":"молоко"},{"тип":"расход","сумма":45000,"категория":"еда","описание":"мясо"}]
+# Свой httpx-клиент: keep-alive амортизирует TLS-рукопожатие, а HTTP/2
+# позволяет параллельным запросам делить одно соединение.
+openai_client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10)
+    )
+)
 
-Types: расход, доход, долг
-Categories: еда, транспорт, коммунальные, одежда, здоровье, развлечения, кафе, долг_выдал, долг_получил, зарплата, другое
+# Промпт вынесен в константу: он не меняется между вызовами, так что
+# провайдерский кэш префикса может срабатывать на каждом запросе.
+SYSTEM_PROMPT = """You are a financial message parser. The user writes in Russian or Uzbek.
+Extract every transaction into the "транзакции" array.
 
 Rules:
 - spending/purchase = тип "расход"
@@ -109,44 +195,238 @@ Rules:
 - lent to someone = тип "долг", категория "долг_выдал"
 - borrowed from someone = тип "долг", категория "долг_получил"
 - returned debt = тип "долг"
-
-IMPORTANT: Always return a JSON array [...]. Only JSON, nothing else."""
-
-    response = client.chat.completions.create(
+Put the counterparty or item in "описание"."""
+
+TRANSACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "тип": {"type": "string", "enum": ["расход", "доход", "долг"]},
+        "сумма": {"type": "number"},
+        "категория": {"type": "string", "enum": [
+            "еда", "транспорт", "коммунальные", "одежда", "здоровье",
+            "развлечения", "кафе", "долг_выдал", "долг_получил",
+            "зарплата", "другое"
+        ]},
+        "описание": {"type": "string"}
+    },
+    "required": ["тип", "сумма", "категория", "описание"],
+    "additionalProperties": False
+}
+
+# strict-режим требует объект на верхнем уровне, поэтому массив
+# транзакций завёрнут в поле "транзакции".
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "transactions",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "транзакции": {"type": "array", "items": TRANSACTION_SCHEMA}
+            },
+            "required": ["транзакции"],
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
+
+# Быстрый путь: строки вида "такси 15000" (и списки из таких строк)
+# составляют большинство сообщений и разбираются регуляркой за
+# микросекунды — без сетевого вызова к OpenAI.
+_LINE_RE = re.compile(r"^\s*(?P<desc>[^\d\n]+?)\s+(?P<amt>[\d\s.,]+)\s*$")
+
+# При этих словах строка может быть долгом/доходом — отдаём её LLM.
+_LLM_KEYWORDS = ("одолж", "верн", "займ", "долг", "зарплат", "доход", "получил", "аванс")
+
+_CATEGORY_KEYWORDS = {
+    "такси": "транспорт", "бензин": "транспорт", "метро": "транспорт", "автобус": "транспорт",
+    "молоко": "еда", "хлеб": "еда", "мясо": "еда", "рис": "еда",
+    "овощи": "еда", "фрукты": "еда", "продукты": "еда", "базар": "еда",
+    "кафе": "кафе", "обед": "кафе", "кофе": "кафе",
+    "свет": "коммунальные", "газ": "коммунальные", "вода": "коммунальные",
+    "интернет": "коммунальные", "аптека": "здоровье", "лекарства": "здоровье"
+}
+
+def _parse_fast(text: str):
+    rows = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        low = line.lower()
+        if any(word in low for word in _LLM_KEYWORDS):
+            return None
+        m = _LINE_RE.match(line)
+        if m is None:
+            return None
+        try:
+            amount = _to_amount(m.group("amt"))
+        except ValueError:
+            return None
+        desc = m.group("desc").strip()
+        rows.append({
+            "тип": "расход",
+            "сумма": amount,
+            "категория": _CATEGORY_KEYWORDS.get(desc.lower(), "другое"),
+            "описание": desc
+        })
+    return rows or None
+
+@functools.lru_cache(maxsize=2048)
+def _parse_message_cached(text: str) -> str:
+    response = openai_client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        max_tokens=500,
+        response_format=RESPONSE_FORMAT
+    )
+    return response.choices[0].message.content
+
+def _iter_stream_objects(chunks):
+    # Вырезает законченные {...}-объекты из постепенно приходящего JSON:
+    # следим за глубиной фигурных скобок вне строковых литералов, объекты
+    # транзакций открываются на глубине 2 (внутри массива "транзакции").
+    buf = []
+    depth = 0
+    in_str = False
+    esc = False
+    for chunk in chunks:
+        for ch in chunk:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = not in_str
+            elif not in_str:
+                if ch == "{":
+                    depth += 1
+                    if depth == 2:
+                        buf = [ch]
+                        continue
+                elif ch == "}":
+                    depth -= 1
+                    if depth == 1:
+                        buf.append(ch)
+                        yield json.loads("".join(buf))
+                        buf = []
+                        continue
+            if depth >= 2:
+                buf.append(ch)
+
+def _parse_message_stream(text: str, on_batch, batch_size=10):
+    stream = openai_client.chat.completions.create(
         model="gpt-4o-mini",
         messages=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": text}
         ],
-        max_tokens=500
+        # Потоковый путь включается именно на длинных списках, поэтому
+        # лимит выше обычного; обрезку всё равно ловим по finish_reason.
+        max_tokens=2000,
+        response_format=RESPONSE_FORMAT,
+        stream=True
     )
-    content = response.choices[0].message.content.strip()
-    content = content.replace("```json", "").replace("```", "").strip()
-    return json.loads(content)
+    rows = []
+    pending = []
+    finish_reason = None
+
+    def chunks():
+        nonlocal finish_reason
+        for c in stream:
+            if not c.choices:
+                continue
+            choice = c.choices[0]
+            if choice.finish_reason is not None:
+                finish_reason = choice.finish_reason
+            yield choice.delta.content or ""
+
+    for obj in _iter_stream_objects(chunks()):
+        rows.append(obj)
+        pending.append(obj)
+        if len(pending) >= batch_size:
+            on_batch(pending)
+            pending = []
+    if finish_reason == "length":
+        # Ответ оборвался на max_tokens: молча записать усечённый список —
+        # значит соврать "Записано N позиций". Лучше честная ошибка.
+        raise ValueError(f"ответ модели обрезан по max_tokens, разобрано {len(rows)} строк")
+    if pending:
+        on_batch(pending)
+    return rows
+
+# С этого числа строк ответ LLM читаем потоком, записывая готовые
+# транзакции в лист, пока модель догенерирует остальные.
+STREAM_MIN_LINES = 4
+
+def parse_and_record(text: str) -> list:
+    rows = _parse_fast(text)
+    if rows is not None:
+        add_transaction(rows)
+        return rows
+    if text.count("\n") + 1 >= STREAM_MIN_LINES:
+        return _parse_message_stream(text, on_batch=add_transaction)
+    # Кэшируем сырую JSON-строку, а не список: json.loads отдаёт
+    # каждому вызову свежие объекты, которые можно спокойно менять.
+    rows = json.loads(_parse_message_cached(text.lower().strip()))["транзакции"]
+    add_transaction(rows)
+    return rows
 
 # --- ОБРАБОТЧИКИ ---
+STATS_CMDS = frozenset({"итоги", "итог", "статистика", "отчёт", "отчет"})
+DEBT_CMDS = frozenset({"долги", "долг"})
+HELP_CMDS = frozenset({"помощь", "help", "/help", "/start"})
+
+# Статичные ответы собраны один раз при импорте, а не при каждом вызове.
+HELP_MSG = """👋 Привет! Я твой финансовый бот.
+
+Как записывать:
+• такси 15000 — расход
+• зарплата 5000000 — доход
+• одолжил Алишеру 100000 — долг
+• вернул Темур 50000 — возврат
+
+Список с базара:
+молоко 8000
+мясо 45000
+хлеб 3000
+
+Команды:
+• итоги — статистика за месяц
+• долги — кто кому должен
+• помощь — эта подсказка"""
+
+PARSE_ERROR_MSG = "❌ Не смог разобрать. Попробуй:\nтакси 15000\nили список:\nмолоко 8000\nмясо 45000"
+STATS_ERROR_MSG = "❌ Не удалось получить статистику."
+DEBTS_ERROR_MSG = "❌ Не удалось получить список долгов."
+DEBTS_NONE_MSG = "🤝 Долгов нет!"
+DEBTS_SETTLED_MSG = "✅ Все долги погашены!"
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != MY_CHAT_ID:
         return
 
     text = update.message.text.strip()
+    low = text.lower()
 
-    if text.lower() in ["итоги", "итог", "статистика", "отчёт", "отчет"]:
+    if low in STATS_CMDS:
         await send_stats(update)
         return
 
-    if text.lower() in ["долги", "долг"]:
+    if low in DEBT_CMDS:
         await send_debts(update)
         return
 
-    if text.lower() in ["помощь", "help", "/help", "/start"]:
+    if low in HELP_CMDS:
         await send_help(update)
         return
 
     try:
-        await update.message.reply_text("⏳ Записываю...")
-        rows = parse_message(text)
-        add_transaction(rows)
+        rows = await asyncio.to_thread(parse_and_record, text)
 
         if len(rows) == 1:
             r = rows[0]
@@ -160,15 +440,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(msg)
     except Exception as e:
         logger.error(f"Error: {e}")
-        await update.message.reply_text("❌ Не смог разобрать. Попробуй:\nтакси 15000\nили список:\nмолоко 8000\nмясо 45000")
+        await update.message.reply_text(PARSE_ERROR_MSG)
 
 async def send_stats(update: Update):
     try:
-        stats = get_month_stats()
+        stats = await asyncio.to_thread(get_month_stats)
         cat_lines = ""
         if stats["categories"]:
-            sorted_cats = sorted(stats["categories"].items(), key=lambda x: x[1], reverse=True)
-            cat_lines = "\n".join([f"  • {cat}: {int(amount):,} сум" for cat, amount in sorted_cats[:7]])
+            top_cats = heapq.nlargest(7, stats["categories"].items(), key=lambda x: x[1])
+            cat_lines = "\n".join([f"  • {cat}: {int(amount):,} сум" for cat, amount in top_cats])
 
         balance = stats["income"] - stats["expense"]
         balance_emoji = "📈" if balance >= 0 else "📉"
@@ -185,34 +465,25 @@ async def send_stats(update: Update):
         await update.message.reply_text(msg)
     except Exception as e:
         logger.error(f"Stats error: {e}")
-        await update.message.reply_text("❌ Не удалось получить статистику.")
+        await update.message.reply_text(STATS_ERROR_MSG)
 
 async def send_debts(update: Update):
     try:
-        sheet = get_sheet("Транзакции")
-        records = sheet.get_all_records()
+        values = await asyncio.to_thread(get_cached_values, "Долги")
         debts = {}
+        debts_get = debts.get
 
-        for r in records:
-            t = str(r.get("Тип", "")).lower()
-            cat = str(r.get("Категория", ""))
-            desc = str(r.get("Описание", ""))
+        for row in values[1:]:
             try:
-                amount = float(str(r.get("Сумма", 0)).replace(" ", "").replace(",", ".") or 0)
+                name = row[1].strip()
+                if not name:
+                    continue
+                debts[name] = debts_get(name, 0) + _to_amount(row[2])
             except:
-                amount = 0
-
-            if t == "долг" and desc:
-                name = desc.strip()
-                if name not in debts:
-                    debts[name] = 0
-                if cat == "долг_выдал":
-                    debts[name] += amount
-                elif cat == "долг_получил":
-                    debts[name] -= amount
+                continue
 
         if not debts:
-            await update.message.reply_text("🤝 Долгов нет!")
+            await update.message.reply_text(DEBTS_NONE_MSG)
             return
 
         lines = []
@@ -222,48 +493,37 @@ async def send_debts(update: Update):
             elif amount < 0:
                 lines.append(f"• Ты должен {name}: {int(abs(amount)):,} сум")
 
-        msg = "🤝 Долги:\n\n" + "\n".join(lines) if lines else "✅ Все долги погашены!"
+        msg = "🤝 Долги:\n\n" + "\n".join(lines) if lines else DEBTS_SETTLED_MSG
         await update.message.reply_text(msg)
     except Exception as e:
         logger.error(f"Debts error: {e}")
-        await update.message.reply_text("❌ Не удалось получить список долгов.")
+        await update.message.reply_text(DEBTS_ERROR_MSG)
 
 async def send_help(update: Update):
-    msg = """👋 Привет! Я твой финансовый бот.
-
-Как записывать:
-• такси 15000 — расход
-• зарплата 5000000 — доход
-• одолжил Алишеру 100000 — долг
-• вернул Темур 50000 — возврат
-
-Список с базара:
-молоко 8000
-мясо 45000
-хлеб 3000
-
-Команды:
-• итоги — статистика за месяц
-• долги — кто кому должен
-• помощь — эта подсказка"""
-    await update.message.reply_text(msg)
+    await update.message.reply_text(HELP_MSG)
 
 # --- НАПОМИНАНИЕ ---
-async def send_reminder():
-    bot = Bot(token=TELEGRAM_TOKEN)
-    tz = pytz.timezone(TIMEZONE)
-    now = datetime.now(tz)
+async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now(TZ)
     msg = f"👋 Привет Стас!\n\nУже {now.strftime('%H:%M')}. Не забудь записать расходы за сегодня 📝"
-    await bot.send_message(chat_id=MY_CHAT_ID, text=msg)
+    await context.bot.send_message(chat_id=MY_CHAT_ID, text=msg)
 
 # --- ЗАПУСК ---
 async def main():
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=25, overall_time_period=1,
+            group_max_rate=18, group_time_period=60
+        ))
+        .build()
+    )
+
     # Напоминание в 22:00 Ташкент = 17:00 UTC
-    scheduler = AsyncIOScheduler(timezone=pytz.utc)
-    scheduler.add_job(send_reminder, "cron", hour=17, minute=0)
-    scheduler.start()
+    app.job_queue.run_daily(send_reminder, time=dtime(17, 0, tzinfo=dt_timezone.utc))
 
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
     app.add_handler(CommandHandler("start", handle_message))
     app.add_handler(CommandHandler("help", handle_message))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))